@@ -1,20 +1,22 @@
 import logging
 import pathlib
-from logging.handlers import RotatingFileHandler
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from typing import Tuple, Union
 
 DEFAULT_LOGGING_LEVEL = logging.INFO
 
 
 def create_package_logger(log_dir: Union[str, pathlib.Path],
-                          name: str) -> Tuple[logging.Logger,
-                                              RotatingFileHandler,
-                                              logging.StreamHandler]:
-    """Create logger based on name"""
+                          name: str) -> logging.Logger:
+    """Create logger based on name. The log file <log_dir>/<name>.log is opened
+    when the first record is written"""
     log_dir = pathlib.Path(log_dir)
-    log_filename = log_dir / name
+    log_dir.mkdir(parents=True, exist_ok=True)
+    log_filename = log_dir / f'{name}.log'
     log_filename.unlink(missing_ok=True)
-    _logdir = pathlib.Path(log_filename)
 
     # Initialize logger, set high level to prevent ipython debugs. File level is
     # set below
@@ -25,7 +27,7 @@ def create_package_logger(log_dir: Union[str, pathlib.Path],
         '%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
         datefmt='%Y-%m-%d_%H:%M:%S')
 
-    _file_handler = RotatingFileHandler(_logdir / f'{name}.log', maxBytes=int(5e6), backupCount=2)
+    _file_handler = RotatingFileHandler(log_filename, maxBytes=int(5e6), backupCount=2, delay=True)
     _file_handler.setLevel(DEFAULT_LOGGING_LEVEL)
     _file_handler.setFormatter(_formatter)
 
@@ -37,3 +39,76 @@ def create_package_logger(log_dir: Union[str, pathlib.Path],
     _logger.addHandler(_stream_handler)
 
     return _logger
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Stream handler writing to the current sys.stdout, thus also to a
+    redirected one (e.g. contextlib.redirect_stdout)"""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, _):
+        pass
+
+
+class _PrefixFormatter(logging.Formatter):
+    """Formatter putting a prefix in front of every line of a message"""
+
+    def __init__(self, prefix: str):
+        super().__init__('%(message)s')
+        self.prefix = prefix
+
+    def format(self, record: logging.LogRecord) -> str:
+        return '\n'.join(f'{self.prefix}{line}' for line in super().format(record).split('\n'))
+
+
+class _QueueHandler(QueueHandler):
+    """Queue handler, which writes the records of threads in synchronous mode
+    directly (in order with their other output) instead of putting them into
+    the queue"""
+
+    def __init__(self, _queue: queue.Queue, handler: logging.Handler):
+        super().__init__(_queue)
+        self.handler = handler
+        self._local = threading.local()
+
+    @property
+    def synchronous(self) -> bool:
+        """If the records of the current thread are written directly"""
+        return getattr(self._local, 'synchronous', False)
+
+    @synchronous.setter
+    def synchronous(self, synchronous: bool) -> None:
+        self._local.synchronous = synchronous
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.synchronous:
+            self.handler.handle(record)
+        else:
+            super().emit(record)
+
+
+def create_queue_logger(name: str) -> Tuple[logging.Logger, QueueListener, _QueueHandler]:
+    """Create logger writing to stdout in a background thread. Logging a record
+    only puts it into a queue, the returned QueueListener writes it once it is
+    started. Call listener.queue.join() to wait until all records are written.
+    Records of threads with handler.synchronous set are written directly."""
+    _logger = logging.getLogger(name)
+    _logger.setLevel(DEFAULT_LOGGING_LEVEL)
+    _logger.propagate = False
+
+    _stream_handler = _StdoutHandler()
+    _stream_handler.setLevel(DEFAULT_LOGGING_LEVEL)
+    _stream_handler.setFormatter(_PrefixFormatter('<q> '))
+
+    _queue = queue.Queue()
+    _queue_handler = _QueueHandler(_queue, _stream_handler)
+    _logger.addHandler(_queue_handler)
+
+    return _logger, QueueListener(_queue, _stream_handler), _queue_handler
@@ -0,0 +1,65 @@
+"""Cache module storing the outputs of succeeded tasks by digest"""
+import pathlib
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Tuple, Union
+
+
+class ResultCache:
+    """Outputs of tasks stored by their digest. The outputs are kept pickled in
+    memory and are written to a single pickle file by `save()` if a filename is
+    given. If maxsize is given, the least recently used outputs are dropped
+    when the cache grows beyond maxsize entries"""
+
+    def __init__(self, filename: Union[str, pathlib.Path] = None, maxsize: int = None):
+        self.filename = None if filename is None else pathlib.Path(filename)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if self.filename is not None and self.filename.exists():
+            with open(self.filename, 'rb') as f:
+                self._data.update(pickle.load(f))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._data
+
+    def get(self, digest: str) -> Tuple[bool, Any]:
+        """Return (True, output) if the digest is cached, else (False, None)"""
+        with self._lock:
+            try:
+                data = self._data[digest]
+            except KeyError:
+                return False, None
+            self._data.move_to_end(digest)
+        return True, pickle.loads(data)
+
+    def set(self, digest: str, output: Any) -> None:
+        """Store the output. Unpicklable outputs are not cached"""
+        try:
+            data = pickle.dumps(output)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return
+        with self._lock:
+            self._data[digest] = data
+            self._data.move_to_end(digest)
+            if self.maxsize is not None and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all outputs"""
+        with self._lock:
+            self._data.clear()
+
+    def save(self) -> None:
+        """Write the cache to its file"""
+        if self.filename is None:
+            return
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            data = pickle.dumps(dict(self._data))
+        with open(self.filename, 'wb') as f:
+            f.write(data)
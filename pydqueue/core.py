@@ -1,27 +1,79 @@
 """Core module containin queing and task classes"""
-from collections import Counter
-
-import copy
+import asyncio
+import atexit
+import functools
+import hashlib
+import heapq
 import inspect
+import marshal
+import os
+import pickle
+import random
+import sys
+import pathlib
+import threading
+import time
 import types
-from datetime import datetime
-from enum import Enum
-from itertools import count
-from typing import List, Dict, Callable
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from enum import IntEnum
+from typing import List, Dict, Callable, Mapping, NamedTuple, Optional, Tuple, Union
 
 from . import utils
+from ._logger import create_queue_logger
+from .cache import ResultCache
 
 MAX_LINE_LENGTH = 123
+# separators of the tasks in Queue.get_infostr()
+_ARROW = ' --> '
+_LINE_BREAK = '... \n ... --> '
 
-TASK_COUNTER = count()
 DATETIME_FMT = '%Y-%m-%d %H:%M:%S'
-
-
-def qprint(string):
-    print(f'<q> {string}')
-
-
-class TaskFlag(Enum):
+CACHE_FILENAME = 'pydqueue_cache.pkl'
+# maximal number of outputs in the in-memory cache of a queue
+CACHE_MAXSIZE = 1024
+# process wide cache of the tasks with memoize=True
+_memo_cache = ResultCache(maxsize=CACHE_MAXSIZE)
+
+# keyword arguments controlling the queue, which are no input of a task
+_NON_INPUT_KWARGS = ('stop_queue_on_error', 'verbose')
+# options of Queue.run, which are not supported by Queue.run_async
+_RUN_OPTIONS = frozenset(('max_workers', 'cache', 'cache_dir', 'force', 'executor', 'pools'))
+# read-only initial input of all tasks but the first. It is only read (copied
+# into the keyword arguments of a task), never mutated
+_EMPTY_INPUT = types.MappingProxyType({})
+
+
+logger, _log_listener, _log_handler = create_queue_logger('pydqueue.queue')
+_log_listener_lock = threading.Lock()
+_log_listener_started = False
+
+
+def _start_log_listener() -> None:
+    """Start the thread writing the logged records if not yet running"""
+    global _log_listener_started
+    with _log_listener_lock:
+        if not _log_listener_started:
+            _log_listener.start()
+            atexit.register(_log_listener.stop)
+            _log_listener_started = True
+
+
+def _flush_log() -> None:
+    """Wait until all logged records are written. The listener is only started
+    if something was logged"""
+    if not _log_listener_started:
+        if _log_listener.queue.empty():
+            return
+        _start_log_listener()
+    _log_listener.queue.join()
+
+# verbose messages of Queue.run with the colors applied once
+_RUN_MSG_FMT = utils.oktext(utils.make_bold('\n>>> (%d/%d) Run "%s"'))
+_FINISHED_MSG = utils.oktext(utils.make_bold('    ...finished <<<'))
+
+
+class TaskFlag(IntEnum):
     """Task flag"""
     not_started = -1
     failed = 0
@@ -30,39 +82,105 @@ class TaskFlag(Enum):
     none = 99
 
 
+# module level aliases avoid the class attribute lookup in hot loops
+_NOT_STARTED = TaskFlag.not_started
+_SUCCEEDED = TaskFlag.succeeded
+_ERROR = TaskFlag.error
+_FAILED = TaskFlag.failed
+_FLAG_BY_VALUE = {flag.value: flag for flag in TaskFlag}
+
+
+def _slot_names(cls) -> Tuple[str, ...]:
+    """Return the names of all slots of a class including the ones of its bases"""
+    return tuple(attr for klass in cls.__mro__ for attr in klass.__dict__.get('__slots__', ()))
+
+
+def _object_state(obj) -> Dict:
+    """Return the attributes of an object including the ones in slots"""
+    state = dict(getattr(obj, '__dict__', {}))
+    for attr in _slot_names(type(obj)):
+        if attr not in ('__dict__', '__weakref__') and hasattr(obj, attr):
+            state[attr] = getattr(obj, attr)
+    return state
+
+
+def _task_cls_info(cls) -> Tuple[str, bool, bool]:
+    """Return the name of a task class, if it has a callable run attribute and
+    if run takes the random number generator of the task (a parameter `rng`)"""
+    run = getattr(cls, 'run', None)
+    if issubclass(cls, _FunctionTask):
+        return cls.__name__, True, cls.accepts_rng
+    try:
+        parameter = inspect.signature(run).parameters.get('rng')
+    except (TypeError, ValueError):
+        parameter = None
+    accepts_rng = parameter is not None and parameter.kind in (parameter.POSITIONAL_OR_KEYWORD,
+                                                               parameter.KEYWORD_ONLY)
+    return cls.__name__, callable(run), accepts_rng
+
+
+# (second, formatted string) of the last get_time() call
+_last_time = (None, '')
+
+
 def get_time():
-    """get the current time"""
-    return datetime.now().strftime(DATETIME_FMT)
+    """get the current time. DATETIME_FMT has a resolution of one second, thus
+    the string is only formatted once per second"""
+    global _last_time
+    now = int(time.time())
+    second, time_str = _last_time
+    if now != second:
+        time_str = time.strftime(DATETIME_FMT, time.localtime(now))
+        _last_time = (now, time_str)
+    return time_str
 
 
 class Task:
     """Task class"""
+    __slots__ = ('_task_cls_name', '_name', '_obj', '_flag', 'output',
+                 '_start_time', '_end_time', '_err_msg', '_repr', '_rng', '_rng_seed', '_accepts_rng',
+                 '_memoize', '_skip_if_parent_failed')
 
-    def __init__(self, obj: Callable, task_cls_name):
+    def __init__(self, obj: Callable, task_cls_name, accepts_rng: bool = False, memoize: bool = False,
+                 skip_if_parent_failed: bool = False):
         self._task_cls_name = task_cls_name
         self._name = f'{self._task_cls_name}'
         self._obj = obj
 
-        self._flag = TaskFlag.not_started
+        self._flag = _NOT_STARTED
         self.output = None
         self._start_time = None
         self._end_time = None
         self._err_msg = None
+        self._repr = None
+        # created on first use, see rng
+        self._rng = None
+        self._rng_seed = None
+        # pass the rng to the run method of the task object
+        self._accepts_rng = accepts_rng
+        # see task()
+        self._memoize = memoize
+        self._skip_if_parent_failed = skip_if_parent_failed
 
     def __repr__(self) -> str:
-        if self.error_message:
-            return f'{self.name} (flag={self.flag}, err_msg={self.error_message})'
-        return f'<{self.name} (flag={self.flag.name})>'
+        # cached until flag or error message change
+        if self._repr is None:
+            if self._err_msg:
+                self._repr = f'{self._name} (flag={self._flag.name}, err_msg={self._err_msg})'
+            else:
+                self._repr = f'<{self._name} (flag={self._flag.name})>'
+        return self._repr
 
     def __getattr__(self, item):
+        if item == '_obj':
+            # not yet set, e.g. during copy
+            raise AttributeError(item)
         try:
-            return self._obj.__getattribute__(item)
+            # getattr (not __getattribute__) to also delegate through a wrapped Task
+            return getattr(self._obj, item)
         except AttributeError:
-            try:
-                return self.__dict__[item]
-            except KeyError:
-                raise AttributeError(f"'{self.__class__.__name__}' object and "
-                                     f"'{self._obj.__class__.__name__}' object have no attribute '{item}'")
+            raise AttributeError(f"'{self.__class__.__name__}' object and "
+                                 f"'{self._obj.__class__.__name__}' object have no attribute '{item}'")
 
     @property
     def start_time(self) -> str:
@@ -80,22 +198,37 @@ class Task:
         id is generated"""
         return self._name
 
+    @property
+    def rng(self) -> random.Random:
+        """Random number generator of the task seeded from the task name and the
+        digest of the task object (see get_digest), thus reproducible and
+        independent of the global random state (also in other processes). Inside
+        a queue the name includes the task id. If the run method of the task
+        object has a parameter `rng`, the generator is passed to it. A queue
+        seeds it anew on every run. The seed is computed on first use only."""
+        if self._rng is None:
+            if self._rng_seed is None:
+                seed = f'{self._name}{self.get_digest() or ""}'
+                seed = hashlib.blake2b(seed.encode(), digest_size=8).digest()
+                self._rng_seed = int.from_bytes(seed, 'little')
+            self._rng = random.Random(self._rng_seed)
+        return self._rng
+
     @property
     def flag(self) -> TaskFlag:
         """Return the current flag value of the Task"""
-        if isinstance(self._flag, int):
-            return TaskFlag(self._flag)
         return self._flag
 
     @flag.setter
     def flag(self, flag: TaskFlag) -> None:
-        """Set the current flag of the Task"""
-        if isinstance(flag, int):
-            self._flag = TaskFlag(flag)
-        elif isinstance(flag, TaskFlag):
-            self._flag = flag
-        else:
-            raise TypeError(f'Wrong flag type. Must be "int" or "TaskFlag", not {type(flag)}')
+        """Set the current flag of the Task (TaskFlag or its int value)"""
+        try:
+            self._flag = _FLAG_BY_VALUE[flag]
+        except (KeyError, TypeError):
+            if not isinstance(flag, int):
+                raise TypeError(f'Wrong flag type. Must be "int" or "TaskFlag", not {type(flag)}')
+            raise ValueError(f'{flag} is not a valid TaskFlag')
+        self._repr = None
 
     @property
     def error_message(self) -> Exception:
@@ -104,32 +237,163 @@ class Task:
 
     def start(self, *args, **kwargs):
         """Run the task"""
+        if self._accepts_rng:
+            kwargs.setdefault('rng', self.rng)
+        if _log_handler.synchronous:
+            self._start(args, kwargs)
+            return
+        # the task runs in this thread, thus its records are written directly
+        _flush_log()
+        _log_handler.synchronous = True
+        try:
+            self._start(args, kwargs)
+        finally:
+            _log_handler.synchronous = False
+
+    def _start(self, args: Tuple, kwargs: Dict, verbose: bool = None) -> None:
+        """Run the task with the positional arguments `args` and the keyword
+        arguments `kwargs`. The kwargs dictionary is used (and modified) in place.
+        A queue passes its verbose flag, otherwise it is taken from kwargs."""
         stop_queue_on_error = kwargs.pop('stop_queue_on_error', False)
-        qprint(f'task method input: {kwargs}')
+        if verbose is None:
+            verbose = kwargs.get('verbose', False)
+        if verbose:
+            logger.info('task method input: %s', kwargs)
         self._start_time = get_time()
         try:
             output = self._obj.run(*args, **kwargs)
-            # if we come here, the above run succeeded
-            self.flag = TaskFlag.succeeded
-            self.output = output
-            self._err_msg = None
         except Exception as e:
-            self._end_time = get_time()
+            self._set_error(e)
             if stop_queue_on_error:
-                raise Exception(e)
-            self._err_msg = e
-            self.flag = TaskFlag.error
-            self.output = {}
+                # re-raise with the original traceback
+                raise
+            return
+        self._set_output(output)
+
+    def _set_output(self, output) -> None:
+        """Mark the task as succeeded with the given output"""
         self._end_time = get_time()
+        self._flag = _SUCCEEDED
+        self.output = output
+        self._err_msg = None
+        self._repr = None
+
+    def _set_failed(self) -> None:
+        """Mark the task as failed without running it"""
+        self._start_time = self._end_time = get_time()
+        self._flag = _FAILED
+        self.output = {}
+        self._err_msg = None
+        self._repr = None
+
+    def _set_error(self, err: Exception) -> None:
+        """Mark the task as failed with the given error"""
+        self._end_time = get_time()
+        self._flag = _ERROR
+        self.output = {}
+        self._err_msg = err
+        self._repr = None
+
+    def get_digest(self, *args, **kwargs) -> Optional[str]:
+        """Return a digest of the task object and the input (args and kwargs) it
+        is called with. Identical digests are expected to produce identical outputs.
+
+        The key of the digest defaults to the task class, the task object's
+        attributes and the input. A task object can define its own key by a method
+        `cache_key(*args, **kwargs)`. If that returns None, the task is not cached
+        and None is returned. Inside a queue only the keyword arguments of the
+        queue run are passed, the parent outputs are covered by the parent digests.
+        If the key cannot be pickled, the task is not cached either."""
+        obj = self._obj
+        while isinstance(obj, Task):
+            # the task object wrapped by a QTask
+            obj = obj._obj
+        kwargs = {k: v for k, v in kwargs.items() if k not in _NON_INPUT_KWARGS}
+        cache_key = getattr(obj, 'cache_key', None)
+        if cache_key is None:
+            key = (sorted(_object_state(obj).items()), args, sorted(kwargs.items()))
+        else:
+            key = cache_key(*args, **kwargs)
+            if key is None:
+                return None
+        try:
+            # pickle and not repr, which abbreviates e.g. large numpy arrays
+            key = pickle.dumps((type(obj).__module__, type(obj).__qualname__, key), protocol=4)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # a key, which cannot be pickled, cannot be compared
+            return None
+        return hashlib.blake2b(key).hexdigest()
+
+    def set_cached_output(self, output) -> None:
+        """Mark the task as succeeded with an output taken from a cache"""
+        self._start_time = get_time()
+        self._set_output(output)
 
     def copy(self):
-        return copy.copy(self)
+        """Return a shallow copy of the task"""
+        cls = type(self)
+        new = cls.__new__(cls)
+        for attr in _slot_names(cls):
+            try:
+                object.__setattr__(new, attr, object.__getattribute__(self, attr))
+            except AttributeError:
+                # slot not set
+                pass
+        # the copy draws its own random numbers
+        new._rng = None
+        return new
+
+
+def _cell_contents(cell):
+    """Return the value of a closure cell (None if the cell is empty)"""
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return None
+
+
+class _FunctionTask:
+    """Task object calling a function. It is pickled as plain _FunctionTask, so
+    function tasks can be sent to other processes if the function is picklable"""
+    __slots__ = ('function', 'accepts_verbose')
+    # set per function, see task()
+    accepts_rng = False
+
+    def __init__(self, function: Callable, accepts_verbose: bool):
+        self.function = function
+        self.accepts_verbose = accepts_verbose
+
+    def __reduce__(self):
+        return _FunctionTask, (self.function, self.accepts_verbose)
+
+    def cache_key(self, *args, **kwargs):
+        """Key of the digest (see Task.get_digest). The function is identified
+        by its code, default arguments and closure values, thus closures of the
+        same factory function get different keys. Closure values are keyed by
+        their pickled content. If they cannot be pickled, None is returned and
+        the task is not cached"""
+        function = self.function
+        try:
+            closure = pickle.dumps(tuple(_cell_contents(cell) for cell in function.__closure__ or ()),
+                                   protocol=4)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        return (marshal.dumps(function.__code__), function.__defaults__, function.__kwdefaults__,
+                closure, args, sorted(kwargs.items()))
+
+    def run(self, *args, **kwargs):
+        if not self.accepts_verbose:
+            # remove verbose from kwargs
+            kwargs.pop('verbose', None)
+        return self.function(*args, **kwargs)
 
 
 class TaskDecorator:
 
-    def __init__(self, task, name=None):
+    def __init__(self, task, name=None, memoize: bool = False, skip_if_parent_failed: bool = False):
         self.task = task
+        self.memoize = memoize
+        self.skip_if_parent_failed = skip_if_parent_failed
         if name is None:
             self.name = task.__name__
         else:
@@ -138,65 +402,141 @@ class TaskDecorator:
             _ = self.task.run
         except AttributeError:
             raise AttributeError(f'Class {self.__class__} has no method "run"')
+        # inspected once per task class and not for every task created. Kept on
+        # the decorator, thus freed together with the class
+        self._cls_info = _task_cls_info(task)
 
     def __call__(self, *args, **kwargs):
         taskobj = self.task(*args, **kwargs)
-        task_cls_name = taskobj.__class__.__name__
-        try:
-            _task_method = callable(taskobj.__getattribute__('run'))
-        except AttributeError:
-            raise AttributeError(f'Class {self.__class__} has no method "run"')
-        if not callable(taskobj.__getattribute__('run')):
-            raise TypeError(f'Task seems not to be a method of {self.run.__class__}')
-        return Task(taskobj, task_cls_name)
+        if type(taskobj) is self.task:
+            task_cls_name, has_run_method, accepts_rng = self._cls_info
+        else:
+            task_cls_name, has_run_method, accepts_rng = _task_cls_info(type(taskobj))
+        if not has_run_method:
+            # run may still be set on the instance
+            try:
+                run = taskobj.__getattribute__('run')
+            except AttributeError:
+                raise AttributeError(f'Class {self.__class__} has no method "run"')
+            if not callable(run):
+                raise TypeError(f'Task seems not to be a method of {taskobj.__class__}')
+        return Task(taskobj, task_cls_name, accepts_rng, self.memoize, self.skip_if_parent_failed)
 
     def __str__(self):
         return f'<Task "{self.name}">'
 
 
 # wrap Task to allow for deferred calling
-def task(cls=None) -> TaskDecorator:
-    """task wrapper"""
+def task(cls=None, *, memoize: bool = False, skip_if_parent_failed: bool = False) -> TaskDecorator:
+    """task wrapper. With memoize=True the outputs of the tasks are cached for
+    the lifetime of the process (see Queue.run). With skip_if_parent_failed=True
+    a task in a queue is not run but set to failed if none of its parents
+    succeeded (instead of being run with flag=TaskFlag.failed)."""
 
     def wrapper(function):
-        return TaskDecorator(function, 'Unknown')
+        return task(function, memoize=memoize, skip_if_parent_failed=skip_if_parent_failed)
 
     if isinstance(cls, types.FunctionType):
         # it's a function
-        _name = cls.__name__
+        # inspect the signature once and not on every call
+        argspec = inspect.getfullargspec(cls)
+        accepts_verbose = 'verbose' in argspec.args or 'verbose' in argspec.kwonlyargs
+        function_accepts_rng = 'rng' in argspec.args or 'rng' in argspec.kwonlyargs
 
-        class _Task:
-            def __init__(self, *args, **kwargs):
-                pass
+        class _Task(_FunctionTask):
+            __slots__ = ()
+            accepts_rng = function_accepts_rng
 
-            def run(self, *args, **kwargs):
-                if 'verbose' in kwargs:
-                    if 'verbose' not in inspect.getfullargspec(cls).args:
-                        # remove verbose from kwargs
-                        _ = kwargs.pop('verbose', None)
-                return cls(*args, **kwargs)
+            def __init__(self, *args, **kwargs):
+                super().__init__(cls, accepts_verbose)
 
         _Task.__name__ = cls.__name__.capitalize()
-        return TaskDecorator(_Task,
-                             cls.__name__.capitalize())
+        # identify the wrapped function (e.g. in Task.get_digest)
+        _Task.__module__ = cls.__module__
+        _Task.__qualname__ = cls.__qualname__
+        return TaskDecorator(_Task, cls.__name__.capitalize(), memoize=memoize,
+                             skip_if_parent_failed=skip_if_parent_failed)
 
     if cls is None:
         return wrapper
 
     if not isinstance(cls, str):
-        return TaskDecorator(cls, cls.__name__)
+        return TaskDecorator(cls, cls.__name__, memoize=memoize, skip_if_parent_failed=skip_if_parent_failed)
     else:
         return wrapper
 
 
+class _Plan(NamedTuple):
+    """Execution plan of a queue, see Queue._get_plan(). All per task entries
+    are indexed by the task id"""
+    # tasks grouped into topological levels, see Queue.get_levels()
+    levels: List[List["QTask"]]
+    # the parents of task i are parent_ids[parent_offsets[i]:parent_offsets[i + 1]]
+    parent_ids: array
+    parent_offsets: array
+    # the children are stored likewise, child_positions holds the position of
+    # the task in the parents of the child
+    child_ids: array
+    child_positions: array
+    child_offsets: array
+    # number of parents per task
+    n_parents: array
+    # tasks without parents
+    roots: Tuple[int, ...]
+    # length of the critical path from a task to the end of the queue: the
+    # largest sum of the estimated durations (attribute `estimated_duration` of
+    # the task object, default 1) of the task and its descendants along a path
+    cp_length: array
+    # attribute `pool` of the task objects (default None)
+    pools: Tuple[Optional[str], ...]
+    # options of task()
+    memoize: Tuple[bool, ...]
+    skip_if_parent_failed: Tuple[bool, ...]
+    # smallest parent id of a task (-1 without parents), thus shared by siblings
+    sibling_group: array
+
+
+class _InlineExecutor:
+    """Executor running the submitted function immediately in the calling
+    thread. Used by Queue.run with a single worker, thus tasks run in the
+    thread calling run() (e.g. to install signal handlers)"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    @staticmethod
+    def submit(fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
 class Queue:
     """Queue class"""
 
     def __init__(self, tasks: List[Task] = None):
+        # the task id is the index of the task in self.tasks, thus ids are
+        # local to the queue and the same for equally built queues
         if tasks is None:
             self.tasks = []
         else:
-            self.tasks = [QTask(t, self, it) for it, t in enumerate(tasks)]
+            self.tasks = [QTask(t, self, _id) for _id, t in enumerate(tasks)]
+        # dependency graph, updated on every added or removed parent:
+        # ids of the children and number of parents per task
+        self._children = [[] for _ in self.tasks]
+        self._n_parents = array('i', [0]) * len(self.tasks)
+        self._plan = None
+        # get_infostr() per value of use_task_name
+        self._infostr_cache = {}
+        # in-memory cache used by run(cache=True)
+        self._result_cache = None
+        self.verbose = False
 
     def __len__(self) -> int:
         """Number of tasks"""
@@ -204,37 +544,47 @@ class Queue:
 
     def get_infostr(self, use_task_name: bool = False) -> str:
         """returns queue string"""
-        _str = ''
+        try:
+            return self._infostr_cache[use_task_name]
+        except KeyError:
+            pass
+        infostr = self._infostr_cache[use_task_name] = self._build_infostr(use_task_name)
+        return infostr
+
+    def _build_infostr(self, use_task_name: bool) -> str:
+        """builds the queue string, which is cached by get_infostr()"""
         ntasks = self.__len__()
         if ntasks == 0:
             return '<Empty Queue>'
+        names = None
+
+        parts = []
+        append = parts.append
+        running_len = 0
         _nlines = 1
         for itask, _task in enumerate(self.tasks):
-            if use_task_name:
-                _str += f'{_task.name}('
-            else:
-                _str += f'Task<{itask}>('
-            if _task.parents is not None:
-                n_parents = len(_task.parents)
-                for i_ptask, ptask in enumerate(_task.parents):
+            # the part of a task is cached until its parents change
+            part = _task._infostr_parts.get(use_task_name)
+            if part is None:
+                if names is None:
                     if use_task_name:
-                        _str += f'{ptask.name}'
+                        names = [_task.name for _task in self.tasks]
                     else:
-                        _str += f'Task<{ptask._id}>'
-                    if 1 < n_parents and i_ptask != n_parents - 1:
-                        _str += ','
-            if itask == ntasks - 1:
-                _str += ')'
-            else:
-                _str += ')'
+                        names = [f'Task<{_task._id}>' for _task in self.tasks]
+                part = f'{names[itask]}({",".join(names[ptask._id] for ptask in _task.parents)})'
+                _task._infostr_parts[use_task_name] = part
+            append(part)
+            running_len += len(part)
 
             if itask != ntasks - 1:
-                _str += ' --> '
-                if len(_str) > _nlines * MAX_LINE_LENGTH:
+                append(_ARROW)
+                running_len += len(_ARROW)
+                if running_len > _nlines * MAX_LINE_LENGTH:
                     _nlines += 1
-                    _str += '... \n ... --> '
+                    append(_LINE_BREAK)
+                    running_len += len(_LINE_BREAK)
 
-        return _str
+        return ''.join(parts)
 
     def info(self, use_task_name: bool = False):
         """prints queue"""
@@ -249,16 +599,260 @@ class Queue:
     def append(self, task: Task) -> None:
         """append a task"""
         self.tasks.append(QTask(task, self, _id=len(self.tasks)))
+        self._children.append([])
+        self._n_parents.append(0)
+        self._invalidate()
 
     def check(self) -> bool:
         """Performs check, if queue is setup correctly"""
-        task_names = [_task.name for _task in self.tasks if _task.name is not None]
-        if not all(v == 1 for v in Counter(task_names).values()):
-            raise RuntimeError('All tasks must have different names!')
-
-    def run(self, *, initial: Dict = None, stop_queue_on_error: bool = False, **kwargs: Dict):
+        if self._plan is not None:
+            # the queue was checked when the plan was built and is unchanged since
+            return True
+        seen = set()
+        add = seen.add
+        for _task in self.tasks:
+            name = _task.name
+            if name is None:
+                continue
+            if name in seen:
+                raise RuntimeError('All tasks must have different names!')
+            add(name)
+        return True
+
+    def _invalidate(self) -> None:
+        """Drop the execution plan and the info strings after tasks or parents changed"""
+        self._plan = None
+        self._infostr_cache.clear()
+
+    def _add_edge(self, parent_id: int, child_id: int) -> None:
+        """Register a new parent of a task in the dependency graph"""
+        self._children[parent_id].append(child_id)
+        self._n_parents[child_id] += 1
+
+    def _remove_edge(self, parent_id: int, child_id: int) -> None:
+        """Remove a parent of a task from the dependency graph"""
+        self._children[parent_id].remove(child_id)
+        self._n_parents[child_id] -= 1
+
+    def _get_plan(self) -> _Plan:
+        """Check the queue and return its execution plan (see _Plan). The plan
+        is cached until a task or a parent is added or removed."""
+        if self._plan is None:
+            self.check()
+            tasks = self.tasks
+            parent_ids = array('i')
+            parent_offsets = array('i', [0])
+            for _task in tasks:
+                parent_ids.extend(parent_task._id for parent_task in _task.parents)
+                parent_offsets.append(len(parent_ids))
+            child_ids = array('i')
+            child_positions = array('i')
+            child_offsets = array('i', [0])
+            for itask, ichildren in enumerate(self._children):
+                child_ids.extend(ichildren)
+                child_positions.extend(tasks[ichild]._parent_positions[itask] for ichild in ichildren)
+                child_offsets.append(len(child_ids))
+            n_parents = array('i', self._n_parents)
+            roots = tuple(itask for itask, n in enumerate(n_parents) if n == 0)
+            levels = self.get_levels()
+            cp_length = array('d', [0.]) * len(tasks)
+            for level in reversed(levels):
+                for _task in level:
+                    cp_length[_task._id] = getattr(_task, 'estimated_duration', 1) + max(
+                        (cp_length[ichild] for ichild in self._children[_task._id]), default=0)
+            pools = tuple(getattr(_task, 'pool', None) for _task in tasks)
+            memoize = tuple(_task._memoize for _task in tasks)
+            skip_if_parent_failed = tuple(_task._skip_if_parent_failed for _task in tasks)
+            self._plan = _Plan(levels, parent_ids, parent_offsets, child_ids, child_positions, child_offsets,
+                               n_parents, roots, cp_length, pools, memoize, skip_if_parent_failed,
+                               self._sibling_groups())
+        return self._plan
+
+    def _sibling_groups(self) -> array:
+        """Return the smallest parent index of every task (-1 without parents)"""
+        return array('i', (min(_task._parent_positions, default=-1) for _task in self.tasks))
+
+    def _resolve_children(self, itask: int) -> None:
+        """Register the succeeded task as input of its children. A child takes
+        the succeeded parent, which comes first in its list of parents. Only
+        called by the driver thread of run(), thus no lock is needed."""
+        tasks = self.tasks
+        plan = self._plan
+        child_positions = plan.child_positions
+        for i in range(plan.child_offsets[itask], plan.child_offsets[itask + 1]):
+            child_task = tasks[plan.child_ids[i]]
+            position = child_positions[i]
+            if child_task._resolved_parent is None or position < child_task._resolved_parent_position:
+                child_task._resolved_parent = tasks[itask]
+                child_task._resolved_parent_position = position
+
+    def get_levels(self) -> List[List["QTask"]]:
+        """Group the tasks into topological levels. The level of a task is one
+        more than the highest level of its parents, thus all tasks of a level are
+        independent of each other and can be run concurrently."""
+        if self._plan is not None:
+            return [list(level) for level in self._plan.levels]
+        tasks = self.tasks
+        children = self._children
+        n_open_parents = array('i', self._n_parents)
+
+        sibling_group = self._sibling_groups()
+
+        # Kahn's algorithm on the task ids, one level at a time
+        levels = []
+        level = [itask for itask, n in enumerate(n_open_parents) if n == 0]
+        n_visited = 0
+        while level:
+            levels.append([tasks[itask] for itask in level])
+            n_visited += len(level)
+            next_level = []
+            for itask in level:
+                for ichild in children[itask]:
+                    n_open = n_open_parents[ichild] - 1
+                    n_open_parents[ichild] = n_open
+                    if not n_open:
+                        next_level.append(ichild)
+            # siblings next to each other, so they read the output of their parent
+            # one after another
+            next_level.sort(key=lambda itask: (sibling_group[itask], itask))
+            level = next_level
+
+        if n_visited != len(tasks):
+            raise RuntimeError('Queue contains cyclic task dependencies!')
+        return levels
+
+    def _compute_digests(self, initial: Mapping, base_kwargs: Dict) -> None:
+        """Compute the digest of every task object and its keyword arguments
+        (see Task.get_digest). The digest of the run of a task additionally
+        covers the parent it takes the input from and is computed once the
+        parents are finished (see _prepare_task)."""
+        for _task in self.tasks:
+            _task._input_digest = _task.get_digest(**{**(initial if _task._id == 0 else _EMPTY_INPUT),
+                                                      **base_kwargs})
+
+    @staticmethod
+    def _run_digest(_task: "QTask", parent_task: Optional["QTask"], all_parents_failed: bool) -> Optional[str]:
+        """Return the digest of the run of a task from its input digest and the
+        digest of the parent it takes the input from (or a marker, if all parents
+        failed). Equal digests identify equal runs of a (sub-)queue, if the tasks
+        are deterministic. If the task or the used parent has no digest, the
+        digest is None."""
+        if _task._input_digest is None:
+            return None
+        if parent_task is not None:
+            if parent_task._digest is None:
+                return None
+            parent_digest = parent_task._digest
+        else:
+            parent_digest = 'all parents failed' if all_parents_failed else ''
+        return hashlib.blake2b(f'{_task._input_digest}{parent_digest}'.encode()).hexdigest()
+
+    def _run_task(self, itask: int, initial: Mapping, base_kwargs: Dict,
+                  cache: ResultCache = None, force: bool = False) -> bool:
+        """Run a single task of the queue taking the output of the first
+        succeeded parent task as input. `base_kwargs` are the keyword arguments
+        passed to every task including "stop_queue_on_error". If a cache is
+        given, the output is taken from there if a task with the same digest
+        succeeded before (unless force is True). Returns False if the output
+        was taken from the cache. The driver of run() calls _finish_task()
+        afterwards."""
+        task_input = self._prepare_task(itask, initial, base_kwargs, cache, force)
+        if task_input is None:
+            return False
+        self.tasks[itask]._start(*task_input, verbose=self.verbose)
+        return True
+
+    def _prepare_task(self, itask: int, initial: Mapping, base_kwargs: Dict,
+                      cache: ResultCache = None, force: bool = False) -> Optional[Tuple[Tuple, Dict]]:
+        """Return the positional and keyword arguments of a task or None if the
+        output was taken from the cache or the task was skipped, because all
+        parents failed"""
+        tasks = self.tasks
+        _task = tasks[itask]
+        verbose = self.verbose
+        plan = self._plan
+        parent_ids, parent_offsets = plan.parent_ids, plan.parent_offsets
+        first_parent, end_parent = parent_offsets[itask], parent_offsets[itask + 1]
+        if verbose:
+            logger.info(_RUN_MSG_FMT, itask + 1, len(tasks), _task)
+
+        args = ()
+        task_kwargs = {}
+        all_parents_failed = False
+        # parent the input is taken from
+        used_parent = None
+        if _task._resolved_parent is not None:
+            parent_task = used_parent = _task._resolved_parent
+            if verbose:
+                logger.info('Try running from "%s"', parent_task.name)
+            if isinstance(parent_task.output, dict):
+                task_kwargs.update(parent_task.output)
+            else:
+                args = (parent_task.output,)
+        elif first_parent != end_parent:
+            all_parents_failed = True
+            for iparent in range(first_parent, end_parent):
+                parent_task = tasks[parent_ids[iparent]]
+                if verbose:
+                    logger.info('Try running from "%s"', parent_task.name)
+                if parent_task._flag == _SUCCEEDED:
+                    if isinstance(parent_task.output, dict):
+                        task_kwargs.update(parent_task.output)
+                    else:
+                        args = (parent_task.output,)
+                    all_parents_failed = False
+                    used_parent = parent_task
+                    break
+            if all_parents_failed:
+                if verbose:
+                    logger.info('_> All parents failed for some reason')
+                if plan.skip_if_parent_failed[itask]:
+                    _task._set_failed()
+                    return None
+                task_kwargs['flag'] = TaskFlag.failed
+        elif verbose:
+            logger.info('Task %s has no parent', _task)
+
+        _task._digest = self._run_digest(_task, used_parent, all_parents_failed)
+        if cache is not None and _task._digest is not None and not force:
+            found, output = cache.get(_task._digest)
+            if found:
+                _task.set_cached_output(output)
+                if verbose:
+                    logger.info('Took output of %s from cache', _task.name)
+                return None
+
+        task_kwargs.update(initial)
+        task_kwargs.update(base_kwargs)
+        if _task._accepts_rng:
+            task_kwargs.setdefault('rng', _task.rng)
+        return args, task_kwargs
+
+    def _finish_task(self, itask: int, cache: ResultCache = None) -> None:
+        """Store the output of a finished task in the cache (pass None for
+        outputs taken from the cache) and pass it on to the children"""
+        _task = self.tasks[itask]
+        if cache is not None and _task._digest is None:
+            cache = None
+        if _task._flag == _SUCCEEDED:
+            if cache is not None:
+                cache.set(_task._digest, _task.output)
+            self._resolve_children(itask)
+
+        if self.verbose:
+            logger.info(_FINISHED_MSG)
+
+    def run(self, *, initial: Dict = None, stop_queue_on_error: bool = False, max_workers: int = 1,
+            cache: bool = False, cache_dir: Union[str, pathlib.Path] = None, force: bool = False,
+            executor: str = 'thread', pools: Dict[str, int] = None, **kwargs: Dict):
         """Running the queue. Require keyword arguments.
 
+        Tasks are submitted to a thread pool as soon as all their parents are
+        finished, thus independent tasks run concurrently. With a single worker
+        the tasks run in the calling thread. Of the ready tasks the
+        one with the longest critical path is submitted first (set the attribute
+        `estimated_duration` of a task object to weight it, see Queue._get_plan).
+
         Parameters
         ----------
         initial: Dict=None
@@ -267,109 +861,341 @@ class Queue:
             The default (False) will let the queue run through all tasks. Errors will be
             registered but will not lead to a stop of the queue. If stop_queue_on_error is
             True the opposite will happen - the queue will stop on an error.
+        max_workers: int=1
+            Maximum number of tasks running concurrently. The default (1) runs
+            the tasks one after another in the calling thread (unless executor
+            is 'process'). None uses the number of CPUs.
+        cache: bool=False
+            Cache the output of succeeded tasks. A task with the same digest as in a
+            previous run (same task, keyword arguments and parent digests) is not
+            run again but takes the cached output. Tasks created with
+            task(memoize=True) are always cached in a process wide in-memory
+            cache shared by all queues.
+        cache_dir: Union[str, pathlib.Path]=None
+            Directory of the cache file. By default (None) the outputs are cached
+            in memory for the runs of this queue (at most CACHE_MAXSIZE outputs).
+        force: bool=False
+            Run all tasks even if cached outputs exist. The cache is updated.
+        executor: str='thread'
+            'thread' runs the tasks in a thread pool, 'process' in a process pool
+            bypassing the GIL for CPU bound tasks. Tasks of a process pool must be
+            picklable (e.g. module level functions or classes) and changes of the
+            task objects (or of the state of Task.rng) inside the worker processes
+            are not passed back.
+        pools: Dict[str, int]=None
+            Maximum number of concurrently running tasks per pool, e.g.
+            {'gpu': 1}. The pool of a task is the attribute `pool` of the task
+            object. Tasks of other pools are only limited by max_workers.
         """
+        if executor not in ('thread', 'process'):
+            raise ValueError(f'Unknown executor "{executor}". Use "thread" or "process"')
+        # free slots per pool
+        free_slots = dict(pools) if pools else {}
+        for pool_name, n in free_slots.items():
+            if n < 1:
+                raise ValueError(f'Pool "{pool_name}" must allow at least one task, got {n}')
         for t in self.tasks:
             t.reset()
 
-        verbose = kwargs.get('verbose', False)
-        self.check()
-
-        ntasks = len(self.tasks)
-
-        if initial is None:
-            initial = {}
+        self.verbose = verbose = kwargs.get('verbose', False)
+        n_slots = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        # a single worker runs the tasks in this thread: its records are written
+        # directly, thus in order with the output of the tasks
+        synchronous_log = verbose and executor == 'thread' and n_slots == 1
+        if synchronous_log:
+            _flush_log()
+            _log_handler.synchronous = True
+        elif verbose:
+            _start_log_listener()
+        try:
+            plan = self._get_plan()
+            child_ids, child_offsets = plan.child_ids, plan.child_offsets
 
-        if verbose:
-            qprint(f'Starting Queue with {ntasks} tasks')
-            qprint(f'Initial keyword arguments: {initial}')
+            ntasks = len(self.tasks)
 
-        for itask, _task in enumerate(self.tasks):
+            if initial is None:
+                initial = _EMPTY_INPUT
 
             if verbose:
-                qprint(utils.oktext(utils.make_bold(f'\n>>> ({itask + 1}/{ntasks}) Run "{_task}"')))
+                logger.info('Starting Queue with %d tasks', ntasks)
+                logger.info('Initial keyword arguments: %s', initial)
+
+            base_kwargs = {**kwargs, 'stop_queue_on_error': stop_queue_on_error}
 
-            if itask == 0:
-                # first _task can get initial input data
-                flag = TaskFlag.none
+            if cache:
+                if cache_dir is None:
+                    if self._result_cache is None:
+                        self._result_cache = ResultCache(maxsize=CACHE_MAXSIZE)
+                    cache = self._result_cache
+                else:
+                    cache = ResultCache(pathlib.Path(cache_dir) / CACHE_FILENAME)
             else:
-                initial = {}
-
-            # part with all tasks after the first one:
-            if _task.has_parents:  # no parents
-                all_parents_failed = True
-                for parent_task in _task.parents:
-                    if verbose:
-                        qprint(f'Try running from "{parent_task.name}"')
-                    if parent_task.flag == TaskFlag.succeeded:
-                        if isinstance(parent_task.output, dict):
-                            _task.start(**parent_task.output,
-                                        **initial,
-                                        stop_queue_on_error=stop_queue_on_error,
-                                        **kwargs)
+                cache = None
+            if cache is not None or any(plan.memoize):
+                self._compute_digests(initial, base_kwargs)
+            # the cache used by each task
+            task_caches = [cache if cache is not None or not memoize else _memo_cache
+                           for memoize in plan.memoize]
+
+            # number of parents of each task which have not finished yet
+            n_open_parents = array('i', plan.n_parents)
+            cp_length = plan.cp_length
+            sibling_group = plan.sibling_group
+            task_pools = plan.pools
+            # ready tasks as (-critical path length, sibling group, task id)
+            ready = []
+            run_task = self._run_task
+            in_process = executor == 'process'
+            if in_process:
+                executor = ProcessPoolExecutor(max_workers=max_workers)
+            elif n_slots == 1:
+                executor = _InlineExecutor()
+            else:
+                executor = ThreadPoolExecutor(max_workers=max_workers)
+            with executor as pool:
+                running = {}
+                submit_task = pool.submit
+
+                def submit(itask):
+                    # only the first task can get initial input data
+                    _initial = initial if itask == 0 else _EMPTY_INPUT
+                    if not in_process:
+                        running[submit_task(run_task, itask, _initial, base_kwargs, task_caches[itask],
+                                            force)] = itask
+                        return
+                    # prepare the input here, only the run method is executed in the worker
+                    task_input = self._prepare_task(itask, _initial, base_kwargs, task_caches[itask], force)
+                    if task_input is None:
+                        future = Future()
+                        future.set_result(None)
+                    else:
+                        args, task_kwargs = task_input
+                        task_kwargs.pop('stop_queue_on_error', None)
+                        _task = self.tasks[itask]
+                        _task._start_time = get_time()
+                        future = submit_task(_task._obj.run, *args, **task_kwargs)
+                    running[future] = itask, task_input is not None
+
+                def submit_ready():
+                    # tasks of pools without free slot
+                    deferred = []
+                    while ready and len(running) < n_slots:
+                        item = heapq.heappop(ready)
+                        pool_name = task_pools[item[-1]]
+                        if pool_name in free_slots:
+                            if not free_slots[pool_name]:
+                                deferred.append(item)
+                                continue
+                            free_slots[pool_name] -= 1
+                        submit(item[-1])
+                    for item in deferred:
+                        heapq.heappush(ready, item)
+
+                for itask in plan.roots:
+                    heapq.heappush(ready, (-cp_length[itask], sibling_group[itask], itask))
+                submit_ready()
+                pop_running = running.pop
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        itask = pop_running(future)
+                        if in_process:
+                            itask, ran = itask
+                            if ran:
+                                self._apply_result(itask, future, task_caches[itask], stop_queue_on_error, running)
+                            else:
+                                self._finish_task(itask)
+                        elif future.exception() is not None:
+                            # stop_queue_on_error is True: re-raise the exception of the task
+                            for other_future in running:
+                                other_future.cancel()
+                            future.result()
                         else:
-                            _task.start(parent_task.output, **initial, stop_queue_on_error=stop_queue_on_error,
-                                        **kwargs)
-                        all_parents_failed = False
-                        break
-                if all_parents_failed:
-                    if verbose:
-                        qprint(f'_> All parents failed for some reason')
-                    flag = TaskFlag.failed
-                    if 'flag' not in parent_task.output:
-                        kwargs['flag'] = flag
-                    _task.start(**initial, stop_queue_on_error=stop_queue_on_error, **kwargs)
-                    _task._start_time = get_time()
+                            # output of the task was taken from the cache if future.result() is False
+                            self._finish_task(itask, task_caches[itask] if future.result() else None)
+                        if task_pools[itask] in free_slots:
+                            free_slots[task_pools[itask]] += 1
+                        for ichild in child_ids[child_offsets[itask]:child_offsets[itask + 1]]:
+                            n_open = n_open_parents[ichild] - 1
+                            n_open_parents[ichild] = n_open
+                            if not n_open:
+                                heapq.heappush(ready, (-cp_length[ichild], sibling_group[ichild], ichild))
+                    submit_ready()
+        finally:
+            # cache is still the flag of the arguments, if the run failed before
+            if isinstance(cache, ResultCache):
+                cache.save()
+            if synchronous_log:
+                _log_handler.synchronous = False
+            _flush_log()
+
+    async def run_async(self, *, initial: Dict = None, stop_queue_on_error: bool = False, **kwargs: Dict):
+        """Run the queue in the running event loop, e.g. for I/O bound tasks.
+
+        All tasks whose parents are finished run concurrently: If the run method
+        of a task object is a coroutine function (or returns an awaitable), it is
+        awaited, otherwise it is run in the default executor of the loop.
+        `initial` and `stop_queue_on_error` are the same as for run(), all other
+        keyword arguments are passed to every task. The options of run() which
+        control the execution or the cache are not supported and raise a
+        TypeError. Tasks are not memoized."""
+        unsupported = sorted(_RUN_OPTIONS.intersection(kwargs))
+        if unsupported:
+            raise TypeError(f'run_async() does not support the options {unsupported} of run()')
+        for t in self.tasks:
+            t.reset()
+
+        self.verbose = verbose = kwargs.get('verbose', False)
+        if verbose:
+            _start_log_listener()
+        plan = self._get_plan()
+        child_ids, child_offsets = plan.child_ids, plan.child_offsets
+        if initial is None:
+            initial = _EMPTY_INPUT
+        base_kwargs = {**kwargs, 'stop_queue_on_error': stop_queue_on_error}
+        loop = asyncio.get_running_loop()
+
+        async def run_task(itask):
+            _task = self.tasks[itask]
+            # only the first task can get initial input data
+            task_input = self._prepare_task(itask, initial if itask == 0 else _EMPTY_INPUT, base_kwargs)
+            if task_input is None:
+                # skipped
+                self._finish_task(itask)
+                return
+            args, task_kwargs = task_input
+            task_kwargs.pop('stop_queue_on_error', None)
+            run = _task._obj.run
+            _task._start_time = get_time()
+            try:
+                if inspect.iscoroutinefunction(run):
+                    output = await run(*args, **task_kwargs)
+                else:
+                    output = await loop.run_in_executor(None, functools.partial(run, *args, **task_kwargs))
+                    if inspect.isawaitable(output):
+                        output = await output
+            except Exception as e:
+                _task._set_error(e)
+                if stop_queue_on_error:
+                    raise
             else:
-                if verbose:
-                    qprint(f'Task {_task} has no parent')
-                _task.start(**initial, stop_queue_on_error=stop_queue_on_error, **kwargs)
+                _task._set_output(output)
+            self._finish_task(itask)
 
-            if verbose:
-                qprint(utils.oktext(utils.make_bold('    ...finished <<<')))
+        # number of parents of each task which have not finished yet
+        n_open_parents = array('i', plan.n_parents)
+        running = {}
+        try:
+            for itask in plan.roots:
+                running[asyncio.ensure_future(run_task(itask))] = itask
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    itask = running.pop(future)
+                    if future.exception() is not None:
+                        # stop_queue_on_error is True: re-raise the exception of the task
+                        for other_future in running:
+                            other_future.cancel()
+                        future.result()
+                    for ichild in child_ids[child_offsets[itask]:child_offsets[itask + 1]]:
+                        n_open = n_open_parents[ichild] - 1
+                        n_open_parents[ichild] = n_open
+                        if not n_open:
+                            running[asyncio.ensure_future(run_task(ichild))] = ichild
+        finally:
+            _flush_log()
+
+    def _apply_result(self, itask: int, future: Future, cache: Optional[ResultCache],
+                      stop_queue_on_error: bool, running: Dict) -> None:
+        """Set the output or the error of a task which ran in another process"""
+        _task = self.tasks[itask]
+        err = future.exception()
+        if err is None:
+            _task._set_output(future.result())
+        else:
+            _task._set_error(err)
+            if stop_queue_on_error:
+                for other_future in running:
+                    other_future.cancel()
+                future.result()
+        self._finish_task(itask, cache)
 
     def report(self) -> None:
         """Print report about tasks"""
         first_column_length = max(len(_task.name) for _task in self.tasks) + 2
-        qprint('------------')
-        qprint('Queue report')
-        qprint('------------')
+        lines = ['------------', 'Queue report', '------------']
         for _task in self.tasks:
-            if _task.flag == TaskFlag.failed or _task.flag == TaskFlag.error:
-                task_str = utils.failtext(_task.flag.name)
-            elif _task.flag == TaskFlag.succeeded:
-                task_str = utils.oktext(_task.flag.name)
+            flag = _task._flag
+            if flag == _FAILED or flag == _ERROR:
+                task_str = utils.failtext(flag.name)
+            elif flag == _SUCCEEDED:
+                task_str = utils.oktext(flag.name)
             else:
-                task_str = _task.flag.name
+                task_str = flag.name
             if _task.error_message is not None:
-                qprint(f'{_task.name:>{first_column_length}}: {task_str:<18} '
-                       f'({_task.start_time:>} - {_task.end_time:>}) err: {_task.error_message.__repr__()}')
+                lines.append(f'{_task.name:>{first_column_length}}: {task_str:<18} '
+                             f'({_task.start_time} - {_task.end_time}) err: {_task.error_message.__repr__()}')
+            elif _task.end_time is None:
+                lines.append(f'{_task.name:>{first_column_length}}: {task_str:<18} '
+                             f'({_task.start_time} - <not_finished>)')
             else:
-                if _task.end_time is None:
-                    qprint(f'{_task.name:>{first_column_length}}: {task_str:<18} '
-                           f'({_task.start_time:>} - <not_finished>)')
-                else:
-                    qprint(f'{_task.name:>{first_column_length}}: {task_str:<18} '
-                           f'({_task.start_time:>} - {_task.end_time:>})')
+                lines.append(f'{_task.name:>{first_column_length}}: {task_str:<18} '
+                             f'({_task.start_time} - {_task.end_time})')
+        logger.info('\n'.join(lines))
+        _flush_log()
 
 
 class QTask(Task):
     """Wrapper around task available inside a queue class"""
+    __slots__ = ('parents', '_parent_positions', '_parent_name_index', '_resolved_parent',
+                 '_resolved_parent_position', '_queue', '_id', '_input_digest', '_digest',
+                 '_infostr_parts')
 
     def __init__(self, _task: Task, _queue: Queue, _id: int):
-        super().__init__(_task, _task._task_cls_name)
+        super().__init__(_task, _task._task_cls_name, _task._accepts_rng, _task._memoize,
+                         _task._skip_if_parent_failed)
         self.parents = []
+        # maps the ids and the names of the parents to their index in self.parents
+        self._parent_positions = {}
+        self._parent_name_index = {}
+        # first succeeded parent, set by the queue when a parent succeeds
+        self._resolved_parent = None
+        self._resolved_parent_position = None
+        # digests of the task object and its input and of the last run, see
+        # Queue._compute_digests
+        self._input_digest = None
+        self._digest = None
         self._queue = _queue
         self._id = _id
-        # overwrite name
-        self._name = f'{self._task_cls_name}<{self._id}>'
+        # overwrite name. Interned, as the names are used as dict keys and
+        # repeated in the queue strings
+        self._name = sys.intern(f'{self._task_cls_name}<{self._id}>')
+        # part of the queue string per use_task_name, see Queue.get_infostr
+        self._infostr_parts = {}
+
+    def copy(self):
+        """Return a shallow copy of the task with an independent list of parents"""
+        new = super().copy()
+        new.parents = list(self.parents)
+        new._parent_positions = dict(self._parent_positions)
+        new._infostr_parts = {}
+        new._parent_name_index = dict(self._parent_name_index)
+        return new
 
     def reset(self):
         """reset error messages and flags"""
-        self._flag = TaskFlag.not_started
+        self._flag = _NOT_STARTED
+        self._resolved_parent = None
+        self._resolved_parent_position = None
         self.output = None
         self._start_time = None
         self._end_time = None
         self._err_msg = None
+        self._repr = None
+        self._input_digest = None
+        self._digest = None
+        # every run draws the same random numbers
+        self._rng = None
 
     @property
     def has_parents(self) -> bool:
@@ -384,33 +1210,83 @@ class QTask(Task):
         parent_task: Task
             The task to take as input
         """
-        if parent_task not in self._queue.tasks:
-            raise KeyError(f'Task {parent_task} not in queue: {self._queue.tasks}')
+        self._check_parent(parent_task)
+        if parent_task._id in self._parent_positions:
+            raise ValueError(f'Task {parent_task.name} is already a parent of {self.name}')
+        self._append_parent(parent_task)
+        if self._in_queue():
+            self._queue._invalidate()
+
+    def _check_parent(self, parent_task: "Task") -> None:
+        """raises an error if parent_task cannot become a parent of this task"""
+        queue_tasks = self._queue.tasks
+        if not (isinstance(parent_task, QTask) and parent_task._id < len(queue_tasks)
+                and queue_tasks[parent_task._id] is parent_task):
+            raise KeyError(f'Task {parent_task} not in queue: {queue_tasks}')
         if self._id == parent_task._id:
             raise RuntimeError('Cannot add a task to itself!')
         if self._id < parent_task._id and parent_task.has_parents:
             raise RuntimeError('A task added must has no parents or be computed before this task!')
+
+    def _in_queue(self) -> bool:
+        """If this task is the task of its queue and not a copy of it. Only the
+        parents of the queue's task are part of the dependency graph"""
+        queue_tasks = self._queue.tasks
+        return self._id < len(queue_tasks) and queue_tasks[self._id] is self
+
+    def _append_parent(self, parent_task: "QTask") -> None:
+        """appends a checked parent task"""
+        self._parent_positions[parent_task._id] = len(self.parents)
+        self._parent_name_index[parent_task.name] = len(self.parents)
         self.parents.append(parent_task)
+        self._infostr_parts.clear()
+        if self._in_queue():
+            self._queue._add_edge(parent_task._id, self._id)
 
     def remove_parent(self, index: int) -> None:
         """removes parent at index location in list of parents"""
-        self.parents.pop(index)
+        parents = self.parents
+        parent_task = parents.pop(index)
+        if index < 0:
+            index += len(parents) + 1
+        del self._parent_positions[parent_task._id]
+        del self._parent_name_index[parent_task.name]
+        # only the parents after the removed one move
+        for position in range(index, len(parents)):
+            self._parent_positions[parents[position]._id] = position
+            self._parent_name_index[parents[position].name] = position
+        self._infostr_parts.clear()
+        if self._in_queue():
+            self._queue._remove_edge(parent_task._id, self._id)
+            self._queue._invalidate()
 
     def remove_parent_by_name(self, parent_name: str) -> None:
-        """removes parent at index location in list of parents"""
-        for i, parent in self.parents:
-            if parent.name == parent_name:
-                self.parents.pop(i)
-                return
-        raise IndexError(f'Could not find parent with name {parent_name} in list of parents: '
-                         f'{[p.name for p in self.parents]}')
+        """removes parent with the given name from the list of parents"""
+        try:
+            index = self._parent_name_index[parent_name]
+        except KeyError:
+            raise IndexError(f'Could not find parent with name {parent_name} in list of parents: '
+                             f'{[p.name for p in self.parents]}')
+        self.remove_parent(index)
 
     def add_parents(self, *parent_tasks: "Task") -> None:
-        """Add multiple parent tasks"""
+        """Add multiple parent tasks. Tasks which are already parents (or given
+        twice) are skipped. If one task cannot be added, no task is added."""
         if len(parent_tasks) == 1 and isinstance(parent_tasks[0], list):
             parent_tasks = parent_tasks[0]
+        seen = set(self._parent_positions)
+        new_parents = []
         for parent_task in parent_tasks:
-            self.add_parent(parent_task)
+            self._check_parent(parent_task)
+            if parent_task._id not in seen:
+                seen.add(parent_task._id)
+                new_parents.append(parent_task)
+        if not new_parents:
+            return
+        for parent_task in new_parents:
+            self._append_parent(parent_task)
+        if self._in_queue():
+            self._queue._invalidate()
 
 
 class RQueue:
@@ -0,0 +1,47 @@
+"""Helpers of the simulated simulations used as tasks in the tests"""
+import functools
+import pathlib
+from typing import NamedTuple, Tuple, Union
+
+
+@functools.lru_cache(maxsize=10_000)
+def _path(filename: str) -> pathlib.Path:
+    return pathlib.Path(filename)
+
+
+def as_path(filename: Union[str, pathlib.Path]) -> pathlib.Path:
+    """Return the filename as path. Paths are immutable, thus equal filenames
+    share one path object"""
+    if isinstance(filename, pathlib.Path):
+        return filename
+    return _path(filename)
+
+
+class SimState(NamedTuple):
+    """State passed between the simulated simulations. result -1 means unset"""
+    result: int = -1
+
+
+# states of the first simulations, shared instead of allocated per call
+_STATES = tuple(SimState(result) for result in range(16))
+
+
+def to_state(input_data) -> SimState:
+    """Return the state of a simulation input, which is a SimState or a dict with
+    an optional entry 'result'"""
+    if isinstance(input_data, SimState):
+        return input_data
+    if isinstance(input_data, dict):
+        return SimState(input_data.get('result', -1))
+    return SimState()
+
+
+def step(flag, state: SimState, coin: float) -> Tuple[bool, SimState]:
+    """One simulated simulation: fails for coin < 0.5 and increments the result
+    of the input state otherwise. An unset result or a missing flag start at 0."""
+    result = state.result if flag and state.result != -1 else 0
+    success = bool(coin >= 0.5)
+    result += int(success)
+    if result < len(_STATES):
+        return success, _STATES[result]
+    return success, SimState(result)
@@ -1,9 +1,46 @@
+import asyncio
+import contextlib
+import io
 import pathlib
 import random
+import tempfile
+import threading
+import time
 import unittest
 from typing import Union
 
+import numpy as np
+
 import pydqueue as dq
+from _sim_util import as_path, step, to_state
+
+
+def _double(x=1):
+    return dict(x=2 * x)
+
+
+# inputs of the calls of the counting tasks. Not a closure value, which would
+# be part of the cache key
+_ncalls = []
+
+
+def _count_calls(x=0):
+    _ncalls.append(x)
+    return dict(x=x + 1)
+
+
+# if _parent_of_increment fails
+_parent_fails = [True]
+
+
+def _parent_of_increment():
+    if _parent_fails[0]:
+        raise IOError('failing on purpose')
+    return dict(x=10)
+
+
+def _increment(x=0, **kwargs):
+    return dict(y=x + 1)
 
 
 class TestQueue(unittest.TestCase):
@@ -61,12 +98,12 @@ class TestQueue(unittest.TestCase):
             """Object used to create instances for each task"""
 
             def __init__(self, simulation_filename: Union[str, pathlib.Path]):
-                self.simulation_filename = pathlib.Path(simulation_filename)
+                self.simulation_filename = as_path(simulation_filename)
 
             def info(self):
                 print('Info about the simulation')
 
-            def run(self, input_data, nproc: int, flag=None, **kwargs):
+            def run(self, input_data, nproc: int, flag=None, *, rng, **kwargs):
                 """simulate a simulation. A random variable decides if simulation fails or not"""
                 assert isinstance(nproc, int)
                 if self.simulation_filename is None:
@@ -76,25 +113,10 @@ class TestQueue(unittest.TestCase):
                 if verbose:
                     print(f'filename: {self.simulation_filename}')
 
-                if 'result' in input_data:
-                    if not flag:
-                        input_data['result'] = 0
-                    if random.random() < 0.5:
-                        # make simulation fail
-                        if verbose:
-                            print('Simulation failed')
-                        return False, {'result': input_data['result']}
-                    if verbose:
-                        print('Simulation succeeded')
-                    return True, {'result': input_data['result'] + 1}
-                if random.random() < 0.5:
-                    # make simulation fail
-                    if verbose:
-                        print('Simulation failed')
-                    return False, {'result': 0}
+                success, output = step(flag, to_state(input_data), rng.random())
                 if verbose:
-                    print('Simulation succeeded')
-                return True, {'result': 1}
+                    print('Simulation succeeded' if success else 'Simulation failed')
+                return success, output
 
         # initialize the first simulation
         A = Simulation('one')
@@ -128,17 +150,21 @@ class TestQueue(unittest.TestCase):
 
     def test_using_function(self):
 
+        ntasks = 10
+        # one coin flip per task, consumed bit by bit
+        coins = random.getrandbits(ntasks)
+        ibit = iter(range(ntasks))
+
         def randomfun():
             """method MUST take arguments"""
-            rm = random.random()
-            if rm < 0.5:
+            if (coins >> next(ibit)) & 1:
                 1 / 0  # trigger an error
                 return False, {}  # will not reach this
             return True, {}
 
         mytask = dq.task(randomfun)
 
-        q = dq.Queue([mytask() for _ in range(10)])
+        q = dq.Queue([mytask() for _ in range(ntasks)])
         q.run()
         print(q)
         q.report()
@@ -165,5 +191,410 @@ class TestQueue(unittest.TestCase):
             q[1].add_parent(t1)
         q[1].add_parent(q[0])
         self.assertEqual(q.__str__(), 'Dummy<0>() --> Dummy<1>(Dummy<0>)')
+        with self.assertRaises(ValueError):
+            q[1].add_parent(q[0])
+        # duplicates are skipped by add_parents
+        q[1].add_parents(q[0], q[0])
+        self.assertEqual(q.__str__(), 'Dummy<0>() --> Dummy<1>(Dummy<0>)')
         q[1].remove_parent(0)
         self.assertEqual(q.__str__(), 'Dummy<0>() --> Dummy<1>()')
+        q[1].add_parent(q[0])
+        with self.assertRaises(IndexError):
+            q[1].remove_parent_by_name('Dummy<1>')
+        q[1].remove_parent_by_name('Dummy<0>')
+        self.assertEqual(q.__str__(), 'Dummy<0>() --> Dummy<1>()')
+
+    def test_parallel_run(self):
+        def double(x=1):
+            return dict(x=2 * x)
+
+        mytask = dq.task(double)
+
+        q = dq.Queue([mytask() for _ in range(5)])
+        q[1].add_parent(q[0])
+        q[2].add_parent(q[0])
+        q[3].add_parents(q[1], q[2])
+        self.assertEqual([[t.name for t in level] for level in q.get_levels()],
+                         [['Double<0>', 'Double<4>'], ['Double<1>', 'Double<2>'], ['Double<3>']])
+
+        q.run(initial=dict(x=1), max_workers=4)
+        self.assertEqual(q[3].output, dict(x=8))
+        self.assertEqual(q[4].output, dict(x=2))
+        for _task in q.tasks:
+            self.assertEqual(_task.flag, dq.core.TaskFlag.succeeded)
+
+        # changing the parents after a run updates the plan
+        q[3].remove_parent(0)
+        q[4].add_parent(q[3])
+        self.assertEqual([[t.name for t in level] for level in q.get_levels()],
+                         [['Double<0>'], ['Double<1>', 'Double<2>'], ['Double<3>'], ['Double<4>']])
+        q.run(initial=dict(x=1), max_workers=4)
+        self.assertEqual(q[4].output, dict(x=16))
+
+    def test_process_run(self):
+        mytask = dq.task(_double)
+
+        q = dq.Queue([mytask() for _ in range(4)])
+        q[1].add_parent(q[0])
+        q[2].add_parent(q[0])
+        q[3].add_parents(q[1], q[2])
+        q.run(initial=dict(x=1), max_workers=2, executor='process')
+        self.assertEqual(q[3].output, dict(x=8))
+        for _task in q.tasks:
+            self.assertEqual(_task.flag, dq.core.TaskFlag.succeeded)
+
+        with self.assertRaises(ValueError):
+            q.run(executor='fiber')
+
+    def test_failed_parent_flag(self):
+        def fail():
+            raise ValueError('failing on purpose')
+
+        def echo(**kwargs):
+            return kwargs
+
+        q = dq.Queue([dq.task(fail)(), dq.task(echo)(), dq.task(echo)()])
+        q[1].add_parent(q[0])
+        q.run(answer=42)
+        self.assertEqual(q[0].flag, dq.core.TaskFlag.error)
+        self.assertEqual(q[1].output, dict(flag=dq.core.TaskFlag.failed, answer=42))
+        # the flag must not leak into unrelated tasks:
+        self.assertEqual(q[2].output, dict(answer=42))
+
+    def test_skip_if_parent_failed(self):
+        ncalls = []
+
+        def fail():
+            raise ValueError('failing on purpose')
+
+        @dq.task(skip_if_parent_failed=True)
+        def echo(**kwargs):
+            ncalls.append(kwargs)
+            return kwargs
+
+        q = dq.Queue([dq.task(fail)(), echo(), echo(), echo()])
+        q[1].add_parent(q[0])
+        q[2].add_parent(q[1])
+        q.run(answer=42)
+        self.assertEqual([t.flag for t in q.tasks],
+                         [dq.core.TaskFlag.error, dq.core.TaskFlag.failed, dq.core.TaskFlag.failed,
+                          dq.core.TaskFlag.succeeded])
+        self.assertEqual(ncalls, [dict(answer=42)])
+
+    def test_cache(self):
+        ncalls = _ncalls
+        ncalls.clear()
+        mytask = dq.task(_count_calls)
+        q = dq.Queue([mytask(), mytask()])
+        q[1].add_parent(q[0])
+        with tempfile.TemporaryDirectory() as cache_dir:
+            q.run(initial=dict(x=0), cache=True, cache_dir=cache_dir)
+            self.assertEqual(ncalls, [0, 1])
+            q.run(initial=dict(x=0), cache=True, cache_dir=cache_dir)
+            self.assertEqual(ncalls, [0, 1])
+            self.assertEqual(q[1].output, dict(x=2))
+            self.assertEqual(q[1].flag, dq.core.TaskFlag.succeeded)
+            q.run(initial=dict(x=1), cache=True, cache_dir=cache_dir)
+            self.assertEqual(ncalls, [0, 1, 1, 2])
+            q.run(initial=dict(x=1), cache=True, cache_dir=cache_dir, force=True)
+            self.assertEqual(ncalls, [0, 1, 1, 2, 1, 2])
+
+    def test_cache_depends_on_used_parent(self):
+        for memoize in (False, True):
+            q = dq.Queue([dq.task(_parent_of_increment)(), dq.task(_increment, memoize=memoize)()])
+            q[1].add_parent(q[0])
+            _parent_fails[0] = True
+            q.run(cache=not memoize)
+            self.assertEqual(q[1].output, dict(y=1))
+            # the child takes the input of the parent now and is run again
+            _parent_fails[0] = False
+            q.run(cache=not memoize)
+            self.assertEqual(q[1].output, dict(y=11))
+
+    def test_report_to_redirected_stdout(self):
+        q = dq.Queue([dq.task(_double)()])
+        q.run()
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            q.report()
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[:3], ['<q> ------------', '<q> Queue report', '<q> ------------'])
+        self.assertTrue(all(line.startswith('<q> ') for line in lines))
+
+    def test_verbose_output_in_order(self):
+        def say_hello(**kwargs):
+            print('hello')
+            return {}
+
+        q = dq.Queue([dq.task(say_hello)(), dq.task(say_hello)()])
+        q[1].add_parent(q[0])
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            q.run(verbose=True)
+        lines = [line for line in stdout.getvalue().splitlines() if line.strip() != '<q>']
+        self.assertTrue(lines[0].startswith('<q> Starting Queue'))
+        hello_lines = [i for i, line in enumerate(lines) if line == 'hello']
+        finished_lines = [i for i, line in enumerate(lines) if 'finished' in line]
+        self.assertEqual(len(hello_lines), 2)
+        # every task prints between its run message and its finished message
+        for hello_line, finished_line in zip(hello_lines, finished_lines):
+            self.assertTrue(lines[hello_line - 1].startswith('<q> task method input'))
+            self.assertEqual(finished_line, hello_line + 1)
+
+    def test_task_ids_per_queue(self):
+        mytask = dq.task(_double)
+        q1 = dq.Queue([mytask(), mytask()])
+        q2 = dq.Queue([mytask()])
+        q2.append(mytask())
+        self.assertEqual([t.name for t in q1.tasks], [t.name for t in q2.tasks])
+        self.assertEqual([t._id for t in q2.tasks], [0, 1])
+
+    def test_copy_task(self):
+        def dummy():
+            return {}
+
+        mytask = dq.task(dummy)
+        q = dq.Queue([mytask(), mytask()])
+        q[1].add_parent(q[0])
+        task_copy = q[1].copy()
+        self.assertIsInstance(task_copy, dq.core.QTask)
+        self.assertEqual(task_copy.name, q[1].name)
+        task_copy.remove_parent(0)
+        self.assertEqual(len(q[1].parents), 1)
+        self.assertEqual(len(task_copy.parents), 0)
+        # the copy is not part of the dependency graph of the queue
+        self.assertEqual([[t._id for t in level] for level in q.get_levels()], [[0], [1]])
+        task_copy.add_parent(q[0])
+        self.assertEqual([[t._id for t in level] for level in q.get_levels()], [[0], [1]])
+
+    def test_stop_queue_on_error(self):
+        def fail():
+            raise ValueError('failing on purpose')
+
+        def dummy():
+            return {}
+
+        q = dq.Queue([dq.task(fail)(), dq.task(dummy)()])
+        q[1].add_parent(q[0])
+        with self.assertRaises(ValueError):
+            q.run(stop_queue_on_error=True)
+        self.assertEqual(q[0].flag, dq.core.TaskFlag.error)
+        self.assertEqual(q[0].output, {})
+        self.assertIsInstance(q[0].output, dict)
+        self.assertEqual(q[1].flag, dq.core.TaskFlag.not_started)
+
+    def test_single_worker_in_calling_thread(self):
+        def current_thread():
+            return dict(thread=threading.current_thread())
+
+        q = dq.Queue([dq.task(current_thread)()])
+        q.run()
+        self.assertIs(q[0].output['thread'], threading.current_thread())
+        q.run(max_workers=2)
+        self.assertIsNot(q[0].output['thread'], threading.current_thread())
+
+    def test_no_level_barrier(self):
+        event = threading.Event()
+
+        def wait_for_event():
+            return dict(event_set=event.wait(timeout=5))
+
+        def set_event():
+            event.set()
+            return {}
+
+        def dummy(**kwargs):
+            return {}
+
+        # set_event is on the second level but must not wait for wait_for_event:
+        q = dq.Queue([dq.task(wait_for_event)(), dq.task(dummy)(), dq.task(set_event)()])
+        q[2].add_parent(q[1])
+        q.run(max_workers=2)
+        self.assertEqual(q[0].output, dict(event_set=True))
+
+    def test_sibling_order(self):
+        mytask = dq.task(_double)
+        q = dq.Queue([mytask() for _ in range(5)])
+        q[2].add_parent(q[1])
+        q[3].add_parent(q[0])
+        q[4].add_parent(q[1])
+        self.assertEqual([[t._id for t in level] for level in q.get_levels()], [[0, 1], [3, 2, 4]])
+
+    def test_critical_path_first(self):
+        order = []
+
+        @dq.task
+        class Step:
+            def __init__(self, estimated_duration=1):
+                self.estimated_duration = estimated_duration
+
+            def run(self, **kwargs):
+                order.append(self.estimated_duration)
+                return {}
+
+        q = dq.Queue([Step(1), Step(2), Step(1), Step(5)])
+        q[2].add_parent(q[1])
+        self.assertEqual(list(q._get_plan().cp_length), [1, 3, 1, 5])
+        q.run()
+        self.assertEqual(order, [5, 2, 1, 1])
+
+    def test_memoize(self):
+        ncalls = _ncalls
+        ncalls.clear()
+        add_one = dq.task(_count_calls, memoize=True)
+
+        for _ in range(2):
+            # a new but equal queue takes the memoized outputs
+            q = dq.Queue([add_one(), add_one()])
+            q[1].add_parent(q[0])
+            q.run(initial=dict(x=1))
+            self.assertEqual(q[1].output, dict(x=3))
+        self.assertEqual(ncalls, [1, 2])
+
+        q.run(initial=dict(x=5))
+        self.assertEqual(q[1].output, dict(x=7))
+        self.assertEqual(ncalls, [1, 2, 5, 6])
+
+        @dq.task(memoize=True)
+        class AddTwo:
+            __slots__ = ('offset',)
+
+            def __init__(self):
+                self.offset = 2
+
+            def run(self, x=0):
+                ncalls.append(x)
+                return dict(x=x + self.offset)
+
+        # the option is not set on the (slotted) task object
+        for _ in range(2):
+            q = dq.Queue([AddTwo()])
+            q.run(initial=dict(x=10))
+            self.assertEqual(q[0].output, dict(x=12))
+        self.assertEqual(ncalls, [1, 2, 5, 6, 10])
+        add_three = AddTwo()
+        add_three._obj.offset = 3
+        q = dq.Queue([add_three])
+        q.run(initial=dict(x=10))
+        self.assertEqual(q[0].output, dict(x=13))
+
+        def make_constant(n):
+            def constant():
+                return dict(x=n)
+            return constant
+
+        # closures of the same function with different values are different tasks
+        for n in (1, 100):
+            q = dq.Queue([dq.task(make_constant(n), memoize=True)()])
+            q.run()
+            self.assertEqual(q[0].output, dict(x=n))
+
+        def make_first(config):
+            def first():
+                return dict(x=config[0])
+            return first
+
+        # mutable closure values are keyed by their content, not their id,
+        # which is reused after the value is freed
+        for i in range(50):
+            q = dq.Queue([dq.task(make_first([i]), memoize=True)()])
+            q.run()
+            self.assertEqual(q[0].output, dict(x=i))
+        config = [0]
+        q = dq.Queue([dq.task(make_first(config), memoize=True)()])
+        q.run()
+        config[0] = 1
+        q.run()
+        self.assertEqual(q[0].output, dict(x=1))
+
+    def test_pools(self):
+        lock = threading.Lock()
+        n_running = [0]
+        max_running = [0]
+
+        @dq.task
+        class GpuStep:
+            pool = 'gpu'
+
+            def run(self, **kwargs):
+                with lock:
+                    n_running[0] += 1
+                    max_running[0] = max(max_running[0], n_running[0])
+                time.sleep(0.01)
+                with lock:
+                    n_running[0] -= 1
+                return {}
+
+        q = dq.Queue([GpuStep() for _ in range(4)])
+        q.run(max_workers=4, pools={'gpu': 1})
+        self.assertEqual(max_running[0], 1)
+        for _task in q.tasks:
+            self.assertEqual(_task.flag, dq.core.TaskFlag.succeeded)
+        with self.assertRaises(ValueError):
+            q.run(pools={'gpu': 0})
+
+    def test_run_async(self):
+        async def wait_and_double(x=1):
+            await asyncio.sleep(0.01)
+            return dict(x=2 * x)
+
+        def double(x=1):
+            return dict(x=2 * x)
+
+        q = dq.Queue([dq.task(wait_and_double)(), dq.task(double)(), dq.task(wait_and_double)()])
+        q[1].add_parent(q[0])
+        q[2].add_parent(q[1])
+        asyncio.run(q.run_async(initial=dict(x=1)))
+        self.assertEqual(q[2].output, dict(x=8))
+        for _task in q.tasks:
+            self.assertEqual(_task.flag, dq.core.TaskFlag.succeeded)
+        with self.assertRaises(TypeError):
+            asyncio.run(q.run_async(max_workers=2))
+
+    def test_memory_cache(self):
+        ncalls = []
+
+        class Count:
+            def __init__(self, cacheable=True):
+                self.cacheable = cacheable
+
+            def cache_key(self, **kwargs):
+                if self.cacheable:
+                    return 'count'
+                return None
+
+            def run(self, x, **kwargs):
+                ncalls.append(x)
+                return dict(x=x + 1)
+
+        count_task = dq.task(Count)
+        q = dq.Queue([count_task(), count_task(), count_task(False)])
+        q[1].add_parent(q[0])
+        q[2].add_parent(q[1])
+        q.run(initial=dict(x=0), cache=True)
+        self.assertEqual(ncalls, [0, 1, 2])
+        # the last task is not cacheable:
+        q.run(initial=dict(x=0), cache=True)
+        self.assertEqual(ncalls, [0, 1, 2, 2])
+        self.assertEqual(q[2].output, dict(x=3))
+
+    def test_cache_key_by_value(self):
+        ncalls = []
+
+        def total(values, **kwargs):
+            ncalls.append(1)
+            return dict(total=float(values.sum()))
+
+        q = dq.Queue([dq.task(total)()])
+        values = np.zeros(10_000)
+        q.run(initial=dict(values=values), cache=True)
+        # the repr of the array abbreviates the changed value
+        values = values.copy()
+        values[5000] = 1
+        q.run(initial=dict(values=values), cache=True)
+        self.assertEqual(q[0].output, dict(total=1.))
+        self.assertEqual(len(ncalls), 2)
+        # input which cannot be pickled is not cached
+        for _ in range(2):
+            q.run(initial=dict(values=np.ones(2), lock=threading.Lock()), cache=True)
+        self.assertEqual(len(ncalls), 4)
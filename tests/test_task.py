@@ -1,9 +1,12 @@
+import gc
 import pathlib
 import random
 import unittest
+import weakref
 from typing import Union
 
 import pydqueue as dq
+from _sim_util import as_path, step, to_state
 
 
 @dq.task
@@ -11,9 +14,9 @@ class Simulation:
     """Object used to create instances for each task"""
 
     def __init__(self, simulation_filename: Union[str, pathlib.Path]):
-        self.simulation_filename = pathlib.Path(simulation_filename)
+        self.simulation_filename = as_path(simulation_filename)
 
-    def run(self, flag, input_data, **kwargs):
+    def run(self, flag, input_data, rng, **kwargs):
         """simulate a simulation. A random variable decides if simulation fails or not"""
 
         if self.simulation_filename is None:
@@ -23,25 +26,10 @@ class Simulation:
         if verbose:
             print(f'filename: {self.simulation_filename}')
 
-        if 'result' in input_data:
-            if not flag:
-                input_data['result'] = 0
-            if random.random() < 0.5:
-                # make simulation fail
-                if verbose:
-                    print('Simulation failed')
-                return False, {'result': input_data['result']}
-            if verbose:
-                print('Simulation succeeded')
-            return True, {'result': input_data['result'] + 1}
-        if random.random() < 0.5:
-            # make simulation fail
-            if verbose:
-                print('Simulation failed')
-            return False, {'result': 0}
+        success, output = step(flag, to_state(input_data), rng.random())
         if verbose:
-            print('Simulation succeeded')
-        return True, {'result': 1}
+            print('Simulation succeeded' if success else 'Simulation failed')
+        return success, output
 
 
 class TestTask(unittest.TestCase):
@@ -50,3 +38,92 @@ class TestTask(unittest.TestCase):
         t = Simulation('testfile')
         self.assertIsInstance(t, dq.core.Task)
         t.run('hallo')
+
+    def test_copy(self):
+        t = Simulation('testfile')
+        t.flag = dq.core.TaskFlag.succeeded
+        t_copy = t.copy()
+        self.assertIsNot(t_copy, t)
+        self.assertIs(t_copy._obj, t._obj)
+        self.assertEqual(t_copy.flag, dq.core.TaskFlag.succeeded)
+        self.assertEqual(t_copy.name, t.name)
+
+    def test_slots(self):
+        @dq.task
+        def noop():
+            pass
+
+        t = noop()
+        for obj in (t, t._obj):
+            with self.assertRaises(AttributeError):
+                object.__getattribute__(obj, '__dict__')
+
+    def test_rng(self):
+        t = Simulation('testfile')
+        numbers = [t.rng.random() for _ in range(3)]
+        # equal task objects draw equal numbers
+        t = Simulation('testfile')
+        self.assertEqual([t.rng.random() for _ in range(3)], numbers)
+        t = Simulation('other')
+        self.assertNotEqual([t.rng.random() for _ in range(3)], numbers)
+        q = dq.Queue([Simulation('testfile'), Simulation('testfile')])
+        self.assertNotEqual(q[0].rng.random(), q[1].rng.random())
+        self.assertEqual(q[0].copy().rng.random(), dq.Queue([Simulation('testfile')])[0].rng.random())
+
+    def test_rng_passed_to_run(self):
+        @dq.task
+        def draw(rng):
+            return dict(u=rng.random())
+
+        t = draw()
+        u = t.rng.random()
+        t = draw()
+        t.start()
+        self.assertEqual(t.output, dict(u=u))
+        q = dq.Queue([draw()])
+        for _ in range(2):
+            # every run draws the same numbers
+            q.run()
+            self.assertEqual(q[0].output, dict(u=dq.Queue([draw()])[0].rng.random()))
+        # an rng passed by the caller is not replaced
+        q.run(rng=random.Random(0))
+        self.assertEqual(q[0].output, dict(u=random.Random(0).random()))
+
+    def test_digest_of_static_run(self):
+        @dq.task
+        class Static:
+            @staticmethod
+            def run(**kwargs):
+                return {}
+
+        t = Static()
+        self.assertEqual(t.get_digest(x=1), Static().get_digest(x=1))
+        self.assertNotEqual(t.get_digest(x=1), t.get_digest(x=2))
+        q = dq.Queue([t])
+        q.run(cache=True)
+        self.assertEqual(q[0].flag, dq.core.TaskFlag.succeeded)
+
+    def test_task_class_freed(self):
+        def make_task(n):
+            def constant():
+                return dict(x=n)
+            return dq.task(constant)
+
+        mytask = make_task(1)
+        task_cls = weakref.ref(mytask.task)
+        mytask().start()
+        del mytask
+        gc.collect()
+        self.assertIsNone(task_cls())
+
+    def test_flag(self):
+        t = Simulation('testfile')
+        self.assertEqual(t.flag, dq.core.TaskFlag.not_started)
+        t.flag = 1
+        self.assertIs(t.flag, dq.core.TaskFlag.succeeded)
+        t.flag = dq.core.TaskFlag.error
+        self.assertIs(t.flag, dq.core.TaskFlag.error)
+        with self.assertRaises(TypeError):
+            t.flag = 'error'
+        with self.assertRaises(ValueError):
+            t.flag = 5